@@ -27,9 +27,10 @@ import os
 import time
 import threading
 import csv
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from functools import partial
-from ftplib import FTP
-from io import BytesIO, StringIO
+from ftplib import FTP, all_errors
+from io import BytesIO, TextIOWrapper
 
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import (QVBoxLayout, QLabel, QGridLayout, QLineEdit, QTabWidget, QWidget, QCheckBox)
@@ -44,8 +45,10 @@ from electrum_gui.qt.util import OkButton, WindowModalDialog
 
 class Plugin(BasePlugin):
 
-    wallet = None
-    timer = None
+    # created once per process in __init__ (a QApplication must exist
+    # before QIcon construction), then shared by every update
+    ICON_ON = None
+    ICON_OFF = None
 
     def fullname(self):
         return 'AutoExport'
@@ -58,128 +61,263 @@ class Plugin(BasePlugin):
 
     def __init__(self, parent, config, name):
         BasePlugin.__init__(self, parent, config, name)
+        if Plugin.ICON_ON is None:
+            Plugin.ICON_ON = QIcon(":icons/status_connected.png")
+            Plugin.ICON_OFF = QIcon(":icons/status_disconnected.png")
+        self.wallet = None
+        self._timer_thread = None
+        self._timer_stop = None
+        self._ftp = None
+        self._executor = None
+        self._csv_buf = BytesIO()
+        self._label_cache = {}
+        self._row_fn = None
+        self._last_history_len = None
+        self._last_tip_hash = None
         self.update_settings(initial=True)
 
-    @staticmethod
-    def call_repeatedly(interval, func, *args):
-        stopped = threading.Event()
-        def loop():
-            while not stopped.wait(interval): # the first call is in `interval` secs
-                func(*args)
-        threading.Thread(target=loop).start()    
-        return stopped.set
+    def start_timer(self):
+        if self._timer_thread is not None and self._timer_thread.is_alive():
+            return
+        self._timer_stop = threading.Event()
+        self._timer_thread = threading.Thread(target=self.timer_loop, daemon=True)
+        self._timer_thread.start()
+
+    def stop_timer(self):
+        if self._timer_stop is not None:
+            self._timer_stop.set()
+        self._timer_thread = None
+
+    def timer_loop(self):
+        stop = self._timer_stop
+        while True:
+            # re-read the interval every cycle so settings edits take
+            # effect without tearing down and respawning the thread
+            interval = self.autoexport_interval_seconds or 60
+            if stop.wait(interval): # the first call is in `interval` secs
+                return
+            if self.wallet and self.autoexport_interval_seconds and self.auto_export_enabled():
+                try:
+                    self.export_csv()
+                except Exception as e:
+                    # never let a failed tick (wallet mid-teardown, bad
+                    # row data) kill the timer thread for good
+                    print_error(str(e))
 
     def auto_export_enabled(self):
         return self.autoexport_need_export_to_local or self.autoexport_need_export_to_ftp
 
     def export_csv(self):
-        if self.autoexport_need_export_to_local:
-            self.export_csv_local()
-        if self.autoexport_need_export_to_ftp:
-            self.export_csv_ftp()
-
-    def get_exported_data(self):
+        # bind the snapshot attributes once per tick instead of loading
+        # them from the instance dict at every check below; a sink only
+        # counts if it is both enabled and fully configured, so a
+        # misconfigured tick does zero wallet work
+        local_ok = self.autoexport_need_export_to_local and self.autoexport_local_path
+        ftp_ok = (self.autoexport_need_export_to_ftp
+                  and self.autoexport_ftp_host and self.autoexport_ftp_port
+                  and self.autoexport_ftp_user and self.autoexport_ftp_password)
+        if not (local_ok or ftp_ok):
+            return
         history = self.wallet.get_history()
-        lines = [["transaction_hash","label", "confirmations", "value", "timestamp"]]
-        for item in history:
+        # nothing new since the last tick: skip the CSV build, the local
+        # write and the FTP upload altogether
+        tip_hash = history[-1][0] if history else None
+        if len(history) == self._last_history_len and tip_hash == self._last_tip_hash:
+            return
+        buf = self.build_csv(self.iter_exported_rows(history))
+        # one timestamp per tick, so both sinks agree on the filename
+        filename = time.strftime("%Y_%m_%d__%H_%M_%S") + '.csv'
+        if local_ok and ftp_ok:
+            # the upload is network-bound and can block for seconds, so
+            # run it on the worker while the disk write proceeds here.
+            # the worker gets its own immutable copy of the bytes: if
+            # the wait below times out, the next tick can truncate and
+            # rewrite the shared buffer without corrupting the upload
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1)
+            future = self._executor.submit(self.export_csv_ftp, bytes(buf.getbuffer()), filename)
+            exported = self.export_csv_local(buf, filename)
+            try:
+                exported = future.result(timeout=self.autoexport_interval_seconds or None) or exported
+            except FutureTimeoutError:
+                print_error("FTP upload of %s still running after the export interval" % filename)
+            except Exception as e:
+                print_error(str(e))
+        elif local_ok:
+            exported = self.export_csv_local(buf, filename)
+        elif ftp_ok:
+            exported = self.export_csv_ftp(bytes(buf.getbuffer()), filename)
+        # do not let the reused buffer pin memory after an unusually
+        # large export
+        if buf.getbuffer().nbytes > 128 * 1024:
+            self._csv_buf = BytesIO()
+        # only mark the tick exported if some sink got the data, so a
+        # transient failure (disk full, server down) retries next tick
+        if exported:
+            self._last_history_len = len(history)
+            self._last_tip_hash = tip_hash
+
+    def make_row_fn(self):
+        # build the row formatter once per wallet session: the format
+        # helpers, translated strings, label cache and get_label are
+        # bound as free variables, so the per-row call does no global or
+        # attribute lookups at all
+        fmt_time = format_time
+        fmt_satoshis = format_satoshis
+        label_cache = self._label_cache
+        get_label = self.wallet.get_label
+        unverified = _("unverified")
+        unconfirmed = _("unconfirmed")
+
+        def row_fn(item):
             tx_hash, height, confirmations, timestamp, value, balance = item
             if height > 0:
                 if timestamp is not None:
-                    time_string = format_time(timestamp)
+                    time_string = fmt_time(timestamp)
                 else:
-                    time_string = _("unverified")
+                    time_string = unverified
             else:
-                time_string = _("unconfirmed")
+                time_string = unconfirmed
 
             if value is not None:
-                value_string = format_satoshis(value, True)
+                value_string = fmt_satoshis(value, True)
             else:
                 value_string = '--'
 
             if tx_hash:
-                label = self.wallet.get_label(tx_hash)
+                # labels rarely change between ticks, so cache them and
+                # turn the per-row wallet lookup into a dict hit
+                label = label_cache.get(tx_hash)
+                if label is None:
+                    label = label_cache.setdefault(tx_hash, get_label(tx_hash) or "")
             else:
                 label = ""
 
-            lines.append([tx_hash, label, confirmations, value_string, time_string])
-        return lines
+            return [tx_hash, label, confirmations, value_string, time_string]
+
+        return row_fn
 
-    def export_csv_local(self):
+    def iter_exported_rows(self, history):
+        # generate rows lazily; writerows consumes them one at a time so
+        # the full table never exists as a list next to the CSV buffer
+        yield ["transaction_hash","label", "confirmations", "value", "timestamp"]
+        row_fn = self._row_fn
+        if row_fn is None:
+            row_fn = self._row_fn = self.make_row_fn()
+        for item in history:
+            yield row_fn(item)
+
+    def build_csv(self, rows):
+        # serialize once per tick into a buffer that is reused across
+        # ticks (truncated, not reallocated); both sinks read from it
+        buf = self._csv_buf
+        buf.seek(0)
+        buf.truncate()
+        text_f = TextIOWrapper(buf, encoding='utf-8', newline='', write_through=True)
+        try:
+            csv.writer(text_f, lineterminator='\n').writerows(rows)
+        finally:
+            # always detach, or a garbage-collected wrapper closes the
+            # reused buffer and breaks every later tick
+            text_f.detach()
+        return buf
+
+    def export_csv_local(self, buf, filename):
+        # export_csv only dispatches here when the local sink is enabled
+        # and configured, so no gating re-checks
         try:
-            if not self.autoexport_local_path:
-                return
-            filename = time.strftime("%Y_%m_%d__%H_%M_%S") + '.csv'
             filepath = os.path.join(self.autoexport_local_path, filename)
-
-            lines = self.get_exported_data()
-
-            with open(filepath, "w+") as f:
-                transaction = csv.writer(f, lineterminator='\n')
-                for line in lines:
-                    transaction.writerow(line)
+            with open(filepath, "wb", buffering=65536) as f:
+                f.write(buf.getbuffer())
+            return True
         except Exception as e:
             print_error(str(e))
+            return False
 
     @hook
     def create_status_bar(self, sb):
         if self.autoexport_interval_seconds and (self.auto_export_enabled()):
             auto_export = _("AutoExport: {}sec.".format(self.autoexport_interval_seconds))
             self.status_button = StatusBarButton(
-                QIcon(":icons/status_connected.png"),
+                self.ICON_ON,
                 auto_export,
                 lambda: self.settings_dialog(self, self.window)
             )
         else:
             self.status_button = StatusBarButton(
-                QIcon(":icons/status_disconnected.png"),
+                self.ICON_OFF,
                 _("AutoExport"),
                 lambda: self.settings_dialog(self, self.window)
             )
         sb.addPermanentWidget(self.status_button)
         return sb
 
-    def export_csv_ftp(self):
+    def get_ftp(self):
+        # reuse the control connection across export cycles; a NOOP checks
+        # that the server has not dropped us, otherwise we reconnect
+        if self._ftp is not None:
+            try:
+                self._ftp.voidcmd('NOOP')
+                return self._ftp
+            except all_errors:
+                self.close_ftp()
+        ftp = FTP()
         try:
-            if not self.autoexport_ftp_host or not self.autoexport_ftp_port:
-                return
-            if not self.autoexport_ftp_user or not self.autoexport_ftp_password:
-                return
-            filename = time.strftime("%Y_%m_%d__%H_%M_%S") + '.csv'
-
-            lines = self.get_exported_data()
-
-            ftp = FTP()
             ftp.connect(self.autoexport_ftp_host, int(self.autoexport_ftp_port))
             ftp.login(self.autoexport_ftp_user, self.autoexport_ftp_password)
             if self.autoexport_ftp_dir:
                 ftp.cwd(self.autoexport_ftp_dir)
-
-            str_f = StringIO()
-            transaction = csv.writer(str_f, lineterminator='\n')
-            for line in lines:
-                transaction.writerow(line)
-            f = BytesIO(str_f.getvalue().encode('utf-8'))
-            ftp.storlines("STOR " + filename, f)
-            str_f.close()
-            f.close()
-            
+        except Exception:
+            # do not leak the socket if login or cwd fails halfway
             ftp.close()
+            raise
+        self._ftp = ftp
+        return ftp
+
+    def close_ftp(self):
+        if self._ftp is not None:
+            try:
+                self._ftp.close()
+            except all_errors:
+                pass
+            self._ftp = None
+
+    def export_csv_ftp(self, data, filename):
+        # export_csv only dispatches here when the FTP sink is enabled
+        # and the credentials are set, so no gating re-checks; `data`
+        # is an immutable bytes snapshot taken by the caller
+        try:
+            ftp = self.get_ftp()
+            ftp.storbinary("STOR " + filename, BytesIO(data), blocksize=65536)
+            return True
         except Exception as e:
+            # any failure mid-upload leaves the control or data channel
+            # in an unknown state, so drop the connection and reconnect
+            # on the next tick
+            self.close_ftp()
             print_error(str(e))
+            return False
 
     @hook
     def load_wallet(self, wallet, window):
         self.window = window
         self.wallet = wallet
-        if not self.wallet or not self.autoexport_interval_seconds:
+        if not self.wallet:
             return
-        self.timer = self.call_repeatedly(self.autoexport_interval_seconds, self.export_csv)
+        self.start_timer()
 
     @hook
     def close_wallet(self, wallet):
         self.wallet = None
-        if self.timer:
-            self.timer()
+        self.stop_timer()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        self.close_ftp()
+        self._label_cache.clear()
+        self._row_fn = None
+        self._last_history_len = None
+        self._last_tip_hash = None
 
     def requires_settings(self):
         return True
@@ -197,19 +335,19 @@ class Plugin(BasePlugin):
         self.autoexport_ftp_user = self.config.get('autoexport_ftp_user', '')
         self.autoexport_ftp_password = self.config.get('autoexport_ftp_password', '')
         self.autoexport_ftp_dir = self.config.get('autoexport_ftp_dir', '')
-        if self.timer:
-            self.timer()
-        self.timer = None
-        if initial or not self.wallet or not self.autoexport_interval_seconds:
+        # the persistent connection may point at the old host/cwd; drop
+        # it so the next tick reconnects with the new settings
+        self.close_ftp()
+        if initial or not self.wallet:
             return
-        self.timer = self.call_repeatedly(self.autoexport_interval_seconds, self.export_csv)
+        # the timer thread picks up the new interval on its next cycle
         if self.autoexport_interval_seconds and (self.auto_export_enabled()):
             auto_export = _("AutoExport: {}sec.".format(self.autoexport_interval_seconds))
             self.status_button.setToolTip(auto_export)
-            self.status_button.setIcon(QIcon(":icons/status_connected.png"))
+            self.status_button.setIcon(self.ICON_ON)
         else:
             self.status_button.setToolTip(_("AutoExport"))
-            self.status_button.setIcon(QIcon(":icons/status_disconnected.png"))
+            self.status_button.setIcon(self.ICON_OFF)
 
     def settings_dialog(self, window):
         d = WindowModalDialog(window, _("AutoExport settings"))